@@ -1,51 +1,508 @@
 import os
-import openai
-from streamlit import st
+import asyncio
+import time
+import queue
+import hashlib
+import threading
+import orjson
+import streamlit as st
 
-# Initialize OpenAI client with API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Models offered in the sidebar; the first is the default
+MODELS = ["gpt-4o-mini", "gpt-4.1-mini", "gpt-3.5-turbo"]
+
+# Maximum number of keyword requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Streamed text is redrawn at most this often, however fast tokens arrive
+REDRAW_INTERVAL_SECONDS = 0.1
+
+# Rate-limited or failed requests are retried with exponential backoff by the SDK
+MAX_RETRIES = 5
+
+# Fail a stalled request quickly instead of waiting out the SDK's 10 minute default
+REQUEST_TIMEOUT_SECONDS = 10.0
+
+# Output budget per keyword analysis; generation time grows with every token
+MAX_TOKENS_PER_KEYWORD = 350
+
+# Static instructions lead every request and only the keyword varies at the end,
+# so the shared prefix stays byte-identical and is eligible for prompt caching
+SYSTEM_PROMPT = (
+    "You are a search visibility analyst. For each keyword you are given, provide a "
+    "brief analysis of where it appears in search results: which kinds of sites rank "
+    "for it, what intent the results serve, and notable pages. List URLs in a clear "
+    "format, one per line. Keep the analysis under 200 words."
+)
+GROUP_FORMAT_PROMPT = (
+    "You will be given a numbered list of keywords. Analyze each one separately and "
+    "respond with a JSON object of the form "
+    "{\"results\": [{\"keyword\": \"...\", \"analysis\": \"...\"}]}, "
+    "with one entry per keyword in the order given."
+)
+
+# Batch jobs are polled with exponential backoff, capped at this interval
+BATCH_POLL_MAX_SECONDS = 60
+BATCH_TERMINAL_STATUSES = frozenset({"completed", "failed", "expired", "cancelled"})
+
+# Where completed responses are kept between runs, and for how long
+CACHE_DIR = ".llm_cache"
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# How close two keywords' embeddings must be to share a cached response
+SEMANTIC_DISTANCE_THRESHOLD = 0.1
+
+@st.cache_resource
+def get_event_loop():
+    # One long-lived loop so the cached client's connections outlive each rerun
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_openai_client(api_key):
+    # Heavy client libraries are imported on first search, not on first paint
+    import httpx
+    import openai
+
+    # HTTP/2 multiplexes the concurrent keyword requests over a few kept-alive connections
+    http_client = openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+    )
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        timeout=REQUEST_TIMEOUT_SECONDS,
+        http_client=http_client
+    )
+
+@st.cache_resource
+def get_response_cache():
+    import diskcache
+    return diskcache.Cache(CACHE_DIR)
+
+@st.cache_resource
+def get_vectorizer():
+    from redisvl.utils.vectorize import HFTextVectorizer
+    return HFTextVectorizer("redis/langcache-embed-v1")
+
+@st.cache_resource
+def get_semantic_cache(model):
+    # Raises when Redis can't be reached, so the failure isn't cached and the next search retries
+    from redisvl.extensions.cache.llm import SemanticCache
+    return SemanticCache(
+        name=f"kwrank-{model}",
+        redis_url=os.getenv("REDIS_URL"),
+        distance_threshold=SEMANTIC_DISTANCE_THRESHOLD,
+        ttl=CACHE_TTL_SECONDS,
+        vectorizer=get_vectorizer()
+    )
+
+def semantic_cache_or_none(model):
+    # Fall back to exact-match caching alone when Redis isn't configured or reachable,
+    # or redisvl isn't installed
+    if not os.getenv("REDIS_URL"):
+        return None
+    try:
+        return get_semantic_cache(model)
+    except Exception:
+        return None
+
+def build_request(keyword, model):
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Keyword: \"{keyword}\""}
+        ],
+        "max_tokens": MAX_TOKENS_PER_KEYWORD
+    }
+
+def build_group_request(keyword_list, model):
+    numbered = "\n".join(f"{i}. \"{keyword}\"" for i, keyword in enumerate(keyword_list, 1))
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": GROUP_FORMAT_PROMPT},
+            {"role": "user", "content": f"Keywords:\n{numbered}"}
+        ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": MAX_TOKENS_PER_KEYWORD * len(keyword_list)
+    }
+
+def cache_key(request):
+    # Hash the canonical request so identical requests map to the same entry
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def normalize_keyword(keyword):
+    # Grouped replies may echo a keyword with different case, spacing or the prompt's quotes
+    return " ".join(str(keyword).split()).strip('"').casefold()
+
+def parse_keywords(keywords_input):
+    # One keyword per line, whitespace collapsed. Repeats are searched once, judged the same
+    # way grouped replies are matched, and the first spelling is kept
+    unique = {}
+    for line in keywords_input.split('\n'):
+        keyword = " ".join(line.split())
+        normalized = normalize_keyword(keyword)
+        if normalized:
+            unique.setdefault(normalized, keyword)
+    return list(unique.values())
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def lookup_cached(caches, keyword, model):
+    response_cache, semantic_cache = caches
+
+    # Serve identical requests from the cache without touching the API
+    content = response_cache.get(cache_key(build_request(keyword, model)))
+    if content is not None:
+        return content
+
+    # Reuse the response for a reworded keyword when one is close enough
+    if semantic_cache is not None:
+        try:
+            hits = semantic_cache.check(prompt=keyword)
+        except Exception:
+            hits = []
+        if hits:
+            return hits[0]["response"]
+    return None
+
+def store_cached(caches, keyword, model, content):
+    response_cache, semantic_cache = caches
+    response_cache.set(cache_key(build_request(keyword, model)), content, expire=CACHE_TTL_SECONDS)
+    if semantic_cache is not None:
+        try:
+            semantic_cache.store(prompt=keyword, response=content)
+        except Exception:
+            pass
+
+async def fetch(client, caches, keyword, model, sem, updates):
+    try:
+        # Cache lookups hit disk and may embed the keyword, so keep them off the event loop
+        content = await asyncio.to_thread(lookup_cached, caches, keyword, model)
+        if content is not None:
+            updates.put((keyword, content, True, None))
+            return {keyword: content}
+
+        # Bound concurrency so a long keyword list doesn't trip the rate limit
+        async with sem:
+            response = await client.chat.completions.create(**build_request(keyword, model), stream=True)
+
+            # Pass each new piece on as it arrives instead of waiting for the full reply
+            parts = []
+            finish_reason = None
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    updates.put((keyword, chunk.choices[0].delta.content, False, None))
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+            content = "".join(parts)
+
+        # An answer cut off at max_tokens is shown but never cached
+        if content and finish_reason != "length":
+            await asyncio.to_thread(store_cached, caches, keyword, model, content)
+        updates.put((keyword, "", True, None))
+        return {keyword: content}
+
+    # A failed keyword is reported in its own slot and doesn't end the search
+    except Exception as e:
+        updates.put((keyword, "", True, str(e)))
+        return {keyword: ""}
+
+async def fetch_group(client, caches, keyword_list, model, sem, updates):
+    results = {}
+    pending = []
+    try:
+        cached = await asyncio.gather(
+            *(asyncio.to_thread(lookup_cached, caches, keyword, model) for keyword in keyword_list)
+        )
+        for keyword, content in zip(keyword_list, cached):
+            if content is not None:
+                updates.put((keyword, content, True, None))
+                results[keyword] = content
+            else:
+                pending.append(keyword)
+        if not pending:
+            return results
+
+        # Ask for every uncached keyword in the group with a single request
+        async with sem:
+            # Grouped replies aren't streamed, so allow time to generate every analysis
+            response = await client.chat.completions.create(
+                **build_group_request(pending, model),
+                timeout=REQUEST_TIMEOUT_SECONDS * len(pending)
+            )
+
+        # A reply cut off at max_tokens or otherwise unfinished can't be trusted as JSON
+        choice = response.choices[0]
+        if choice.finish_reason != "stop" or not choice.message.content:
+            raise ValueError(f"Incomplete grouped reply (finish_reason: {choice.finish_reason})")
+        try:
+            entries = orjson.loads(choice.message.content).get("results", [])
+        except (orjson.JSONDecodeError, AttributeError):
+            raise ValueError("Grouped reply was not valid JSON")
+
+        # Match analyses on the keyword they name, never on position in the reply
+        analyses = {}
+        for entry in entries:
+            if isinstance(entry, dict) and isinstance(entry.get("analysis"), str):
+                analyses.setdefault(normalize_keyword(entry.get("keyword", "")), entry["analysis"])
+        for keyword in pending:
+            content = analyses.get(normalize_keyword(keyword), "")
+            if content:
+                await asyncio.to_thread(store_cached, caches, keyword, model, content)
+            updates.put((keyword, content, True, None))
+            results[keyword] = content
+        return results
+
+    # A failed group only fails the keywords that weren't answered yet
+    except Exception as e:
+        for keyword in keyword_list:
+            if keyword not in results:
+                updates.put((keyword, "", True, str(e)))
+                results[keyword] = ""
+        return results
+
+def render_result(slot, content, error):
+    # Shared by the live search and the redraw on later reruns so both look the same
+    if error:
+        slot.error(f"An error occurred: {error}")
+    elif content:
+        slot.code(content)
+    else:
+        slot.error("No results found.")
+
+async def fetch_all(client, caches, keyword_list, model, group_size, updates):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results = {}
+
+    # Fan out all keywords (or groups of keywords) at once and collect them as they finish
+    try:
+        if group_size > 1:
+            tasks = [fetch_group(client, caches, group, model, sem, updates) for group in chunked(keyword_list, group_size)]
+        else:
+            tasks = [fetch(client, caches, keyword, model, sem, updates) for keyword in keyword_list]
+        for task in asyncio.as_completed(tasks):
+            results.update(await task)
+        return results
+    finally:
+        updates.put(None)
+
+def run_search(keyword_list, model, group_size, placeholders, progress_bar):
+    client = get_openai_client(os.getenv("OPENAI_API_KEY"))
+    caches = (get_response_cache(), semantic_cache_or_none(model))
+    updates = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        fetch_all(client, caches, keyword_list, model, group_size, updates),
+        get_event_loop()
+    )
+
+    # Widgets can only be drawn from the script thread. Each pass drains everything the
+    # loop has reported and redraws every changed keyword once with its latest text
+    texts = dict.fromkeys(keyword_list, "")
+    errors = {}
+    finished = set()
+    while True:
+        pass_started = time.monotonic()
+        drained = [updates.get()]
+        while drained[-1] is not None and not updates.empty():
+            drained.append(updates.get_nowait())
+
+        changed = {}
+        for update in drained:
+            if update is None:
+                break
+            keyword, delta, done, error = update
+            texts[keyword] += delta
+            changed[keyword] = (done, error)
+
+        for keyword, (done, error) in changed.items():
+            if done:
+                if error:
+                    errors[keyword] = error
+                render_result(placeholders[keyword], texts[keyword], error)
+                finished.add(keyword)
+            elif texts[keyword]:
+                placeholders[keyword].code(texts[keyword])
+        if changed:
+            progress_bar.progress(len(finished) / len(keyword_list))
+
+        if drained[-1] is None:
+            break
+        time.sleep(max(0.0, REDRAW_INTERVAL_SECONDS - (time.monotonic() - pass_started)))
+
+    return future.result(), errors
+
+async def submit_batch(client, keyword_list, model):
+    lines = [
+        orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_request(keyword, model)
+        })
+        for i, keyword in enumerate(keyword_list)
+    ]
+    batch_file = await client.files.create(file=("keywords.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+async def collect_batch(client, batch, keyword_list):
+    results = {}
+    truncated = set()
+    errors = {}
+    if batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.content.splitlines():
+            record = orjson.loads(line)
+            response = record.get("response")
+            if response and response["status_code"] == 200:
+                keyword = keyword_list[int(record["custom_id"])]
+                choice = response["body"]["choices"][0]
+                results[keyword] = choice["message"]["content"]
+                if choice.get("finish_reason") == "length":
+                    truncated.add(keyword)
+
+    # Requests the batch rejected are listed in a separate error file
+    if batch.error_file_id:
+        output = await client.files.content(batch.error_file_id)
+        for line in output.content.splitlines():
+            record = orjson.loads(line)
+            response = record.get("response") or {}
+            error = record.get("error") or (response.get("body") or {}).get("error") or {}
+            message = error.get("message") or f"Request failed with status {response.get('status_code')}"
+            errors[keyword_list[int(record["custom_id"])]] = message
+    return results, truncated, errors
+
+def run_batch(keyword_list, model, placeholders, progress_bar):
+    client = get_openai_client(os.getenv("OPENAI_API_KEY"))
+    caches = (get_response_cache(), semantic_cache_or_none(model))
+    loop = get_event_loop()
+    results = {}
+    errors = {}
+
+    # Only keywords missing from the cache go into the batch
+    pending = []
+    for keyword in keyword_list:
+        content = lookup_cached(caches, keyword, model)
+        if content is not None:
+            results[keyword] = content
+        else:
+            pending.append(keyword)
+
+    if pending:
+        # Resume polling a batch submitted by an interrupted run instead of paying for it twice
+        batch_ids = st.session_state.setdefault("batch_ids", {})
+        job = (model, tuple(pending))
+        if job not in batch_ids:
+            batch_ids[job] = asyncio.run_coroutine_threadsafe(submit_batch(client, pending, model), loop).result()
+
+        delay = 1
+        while True:
+            batch = asyncio.run_coroutine_threadsafe(client.batches.retrieve(batch_ids[job]), loop).result()
+            counts = batch.request_counts
+            done = counts.completed + counts.failed if counts else 0
+            progress_bar.progress(done / len(pending), text=f"Batch {batch.status}: {done}/{len(pending)} keywords")
+            if batch.status in BATCH_TERMINAL_STATUSES:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+
+        fetched, truncated, errors = asyncio.run_coroutine_threadsafe(collect_batch(client, batch, pending), loop).result()
+        for keyword, content in fetched.items():
+            if content and keyword not in truncated:
+                store_cached(caches, keyword, model, content)
+        results.update(fetched)
+
+        # Forget the batch only once its results are safely collected and cached, and
+        # before anything else that could fail and leave a finished batch stuck in the session
+        del batch_ids[job]
+
+        # Keywords left without an answer take the batch's own failure reason
+        if batch.status != "completed":
+            batch_errors = (batch.errors.data if batch.errors else None) or []
+            reasons = [error.message or error.code or "unknown error" for error in batch_errors]
+            message = f"Batch {batch.status}" + (f": {'; '.join(reasons)}" if reasons else "")
+            for keyword in pending:
+                if keyword not in results:
+                    errors.setdefault(keyword, message)
+
+    # An answer in the output file wins over a stale error for the same keyword
+    errors = {keyword: error for keyword, error in errors.items() if not results.get(keyword)}
+    for keyword in keyword_list:
+        render_result(placeholders[keyword], results.get(keyword), errors.get(keyword))
+    return results, errors
+
+def show_results(keyword_list, results, errors):
+    st.write("\nResults:")
+    for keyword in keyword_list:
+        st.subheader(keyword)
+        render_result(st.empty(), results.get(keyword), errors.get(keyword))
 
 def main():
     # Create a title for the app
     st.title("OpenAI Keyword Research Tool")
-    
+
+    # Smaller, newer models answer faster and cost less per token
+    model = st.sidebar.selectbox("Model", MODELS, index=0)
+
+    # The Batch API is half price but may take up to 24 hours to finish
+    use_batch = st.sidebar.checkbox("Submit as batch (cheaper, up to 24h)")
+
     # Create an input area for keywords
     keywords_input = st.text_area(
-        "Enter Keywords to Search (press Enter or click Clear)",
+        "Enter Keywords to Search, one per line (press Enter or click Clear)",
         value="Type your keywords here..."
     )
-    
+
+    # Let several keywords share one request when the rate limit is per request
+    group_size = st.number_input("Keywords per request", min_value=1, max_value=10, value=1)
+
     # Create buttons: Clear and Search
     clear_button = st.button("Clear Input", key="clear")
     search_button = st.button("Search Keywords", key="search")
-    
+
     if clear_button or keywords_input.strip() == '':
+        st.session_state.pop("last_search", None)
         keywords_input = st.empty()
         return
-    
+
+    keyword_list = parse_keywords(keywords_input)
+    search = (keyword_list, model)
+
     if search_button:
         try:
-            # OpenAI API call
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"Analyze the following keyword(s) and provide a brief analysis of where they appear in search results. List URLs in a clear format."
-                    }
-                ],
-                stream=True
-            )
-            
-            # Extract and display results
+            # Lay out a slot per keyword so each one can stream in independently
+            progress_bar = st.progress(0)
             st.write("\nResults:")
-            if response.choices[0].message.content:
-                st.code(response.choices[0].message.content)
+            placeholders = {}
+            for keyword in keyword_list:
+                st.subheader(keyword)
+                placeholders[keyword] = st.empty()
+
+            # OpenAI API calls, either queued as one batch job or issued concurrently
+            if use_batch:
+                results, errors = run_batch(keyword_list, model, placeholders, progress_bar)
             else:
-                st.error("No results found.")
-                
+                results, errors = run_search(keyword_list, model, group_size, placeholders, progress_bar)
+            st.session_state.last_search = (search, results, errors)
+
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
 
+    # Redraw the last results when another widget triggers a rerun, without searching again
+    elif st.session_state.get("last_search", (None,))[0] == search:
+        _, results, errors = st.session_state.last_search
+        show_results(keyword_list, results, errors)
+
 if __name__ == "__main__":
     main()